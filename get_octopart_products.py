@@ -1,112 +1,540 @@
 import time
+import base64
 import os
+import sys
+import re
+import gzip
+import zlib
+import asyncio
+import threading
+import subprocess
+import logging
+from html import unescape
+from urllib.parse import urlsplit
 from tqdm import tqdm
 
-# HTML/XML parsing
-from bs4 import BeautifulSoup
+# HTTP clients
+import httpx
+import cloudscraper
 
-# The stealthy chromedriver
+# On-disk cache of parsed sub-sitemaps, for incremental re-runs
+import diskcache
+
+# The stealthy chromedriver (only used when plain HTTP gets challenged)
 import undetected_chromedriver as uc
 
-from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-
-# Concurrency
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from selenium.common.exceptions import TimeoutException, JavascriptException
 
 # --- Configuration ---
 SITEMAP_INDEX_URL = 'https://octopart.com/product-sitemap-index.xml'
 OUTPUT_FILE = 'octopart_product_urls.txt'
-MAX_WORKERS = 8
+MAX_CONCURRENT_REQUESTS = 64
+SITEMAP_CACHE_DIR = './sitemap_cache'
+# Cached sitemaps younger than this are reused without even a conditional request
+SITEMAP_CACHE_TTL = 24 * 60 * 60
+# Memory budget for the external `sort -u` that dedupes the results
+SORT_BUFFER_SIZE = '1G'
+REQUEST_TIMEOUT = 60
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                  '(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Accept': 'application/xml,text/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+    # httpx decodes these transparently (br needs the 'brotli' extra)
+    'Accept-Encoding': 'gzip, deflate, br',
+}
+# Extra browser identities tried for the index before falling back to Chromium.
+# A None entry means "use the client's own headers".
+INDEX_HEADER_LADDER = (
+    None,
+    {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
+        'Accept-Language': 'en-US,en;q=0.5',
+    },
+    {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 '
+                      '(KHTML, like Gecko) Version/17.4 Safari/605.1.15',
+        'Accept-Language': 'en-GB,en;q=0.9',
+    },
+)
+# Status codes Cloudflare answers with when it wants to run a challenge
+CHALLENGE_STATUS_CODES = (403, 503)
+# Per-URL warnings go to a file so they don't contend with the progress bar on stdout
+WORKER_LOG_FILE = 'worker.log'
+# Leading bytes of a gzip stream, for .xml.gz sitemaps served as plain files
+GZIP_MAGIC = b'\x1f\x8b'
+# Sitemap <loc> extraction runs straight on the raw bytes, no XML parser needed
+LOC_RE = re.compile(rb'<loc>\s*([^<\s][^<]*?)\s*</loc>')
+
+log = logging.getLogger(__name__)
+
+def create_http_client():
+    """
+    Creates the shared async HTTP client used for all sitemap fetches.
+    """
+    limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS)
+    return httpx.AsyncClient(http2=True, headers=HTTP_HEADERS, timeout=REQUEST_TIMEOUT,
+                             limits=limits, follow_redirects=True)
+
+def decode_sitemap_body(url, content):
+    """
+    Decompresses .xml.gz sitemaps. Those are gzip files in their own right, not
+    a Content-Encoding, so the HTTP client hands them over still compressed.
+    The magic bytes identify them whatever the URL looks like, and also skip
+    bodies a server already decoded on the wire. Returns None for a corrupt
+    or truncated gzip body.
+    """
+    if content.startswith(GZIP_MAGIC):
+        try:
+            return gzip.decompress(content)
+        except (OSError, EOFError, zlib.error) as e:
+            log.warning(f"[WORKER ERROR] Could not decompress {url}: {e}")
+            return None
+    return content
+
+def is_gzip_url(url):
+    """
+    Tells whether a URL names a gzip file, ignoring any query string.
+    """
+    return urlsplit(url).path.endswith('.gz')
+
+# One scraper per worker thread (requests sessions are not thread-safe), so
+# a solved challenge and its clearance cookie are reused for later URLs
+scraper_local = threading.local()
+
+def get_scraper():
+    """
+    Returns this thread's cloudscraper session, creating it on first use.
+    """
+    if not hasattr(scraper_local, 'scraper'):
+        scraper_local.scraper = cloudscraper.create_scraper()
+    return scraper_local.scraper
+
+def fetch_page_with_cloudscraper(url):
+    """
+    Fallback fetcher: retries a challenged URL through cloudscraper.
+    Returns the raw response body, or None if it was still blocked.
+    """
+    scraper = get_scraper()
+    response = scraper.get(url, timeout=REQUEST_TIMEOUT)
+    if response.status_code != 200:
+        return None
+    return decode_sitemap_body(url, response.content)
+
+# --- Shared browser (one Chromium, one tab per concurrent fallback) ---
+# WebDriver sessions are not thread-safe, so every command that touches the
+# browser runs under browser_lock. Tabs still load concurrently, because
+# Target.createTarget returns before the page has finished loading.
+# Upper bound for a tab to finish loading (including a Cloudflare interstitial)
+BROWSER_TIMEOUT = 60
+BROWSER_POLL_INTERVAL = 0.05
+# A tab is done once its document has loaded and it is neither the blank
+# starting page nor Cloudflare's "Just a moment..." interstitial
+DOCUMENT_READY_JS = (
+    "return document.readyState === 'complete'"
+    " && document.URL !== 'about:blank'"
+    " && document.title !== 'Just a moment...'"
+)
+# Chromium only keeps response bodies that fit these buffers, and large sitemaps
+# run to tens of MB; anything bigger can't be read back with Network.getResponseBody
+NETWORK_BUFFER_LIMITS = {
+    'maxResourceBufferSize': 64 * 1024 * 1024,
+    'maxTotalBufferSize': 256 * 1024 * 1024,
+}
+# Trims Chromium's helper processes and JS heap; only one XML document per tab is needed.
+# --single-process is left out on purpose: it is unstable with several tabs open.
+CHROME_ARGS = [
+    '--no-sandbox',
+    '--disable-dev-shm-usage',
+    '--disable-gpu',
+    '--disable-extensions',
+    '--disable-background-networking',
+    '--disable-sync',
+    '--metrics-recording-only',
+    '--mute-audio',
+    '--no-first-run',
+    '--js-flags=--max-old-space-size=256',
+    '--blink-settings=imagesEnabled=false',
+]
+# Only the XML text is needed, so sub-resources are never fetched
+BLOCKED_RESOURCE_PATTERNS = ['*.css', '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.webp', '*.woff*', '*.ttf']
+shared_browser = None
+browser_main_handle = None
+browser_lock = threading.Lock()
+
+def get_shared_browser():
+    """
+    Returns the shared browser, launching it on first use. It runs visible
+    (inside the virtual display on CI), since that is what gets through the
+    Cloudflare challenge. Must be called with browser_lock held.
+    """
+    global shared_browser, browser_main_handle
+    if shared_browser is None:
+        options = uc.ChromeOptions()
+        for arg in CHROME_ARGS:
+            options.add_argument(arg)
+        shared_browser = uc.Chrome(options=options)
+        # ChromeDriver holds window commands until a pending navigation is done,
+        # so this also caps how long one readiness poll can keep browser_lock
+        shared_browser.set_page_load_timeout(BROWSER_TIMEOUT)
+        browser_main_handle = shared_browser.current_window_handle
+    return shared_browser
+
+def close_shared_browser():
+    """
+    Quits the shared browser if it was ever launched.
+    """
+    global shared_browser
+    with browser_lock:
+        if shared_browser is not None:
+            shared_browser.quit()
+            shared_browser = None
+
+def get_browser_session():
+    """
+    Returns the shared browser's cookies and User-Agent, or None if the browser
+    was never launched. Once the browser has solved a Cloudflare challenge, its
+    cf_clearance cookie plus the same User-Agent let plain HTTP through too.
+    """
+    with browser_lock:
+        if shared_browser is None:
+            return None
+        # CDP sees every cookie, not just those of the current tab's domain
+        cookies = shared_browser.execute_cdp_cmd('Network.getAllCookies', {})['cookies']
+        user_agent = shared_browser.execute_cdp_cmd('Browser.getVersion', {})['userAgent']
+    return cookies, user_agent
+
+def apply_browser_session(client):
+    """
+    Copies the shared browser's session (cookies and User-Agent) onto the HTTP client.
+    """
+    try:
+        session = get_browser_session()
+    except Exception as e:
+        log.warning(f"[BROWSER ERROR] Could not read the browser session: {e}")
+        return
+    if session is None:
+        return
+    cookies, user_agent = session
+    for cookie in cookies:
+        client.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'])
+    client.headers['User-Agent'] = user_agent
+    print(f"-> Reusing the browser session ({len(cookies)} cookies) for plain HTTP requests.")
+
+def get_document_body(driver):
+    """
+    Returns the raw bytes of the current tab's main document. driver.page_source
+    would have Chromium re-serialize the parsed DOM and ship it back as JSON;
+    Network.getResponseBody hands over the response as received instead.
+    The main resource of a navigation uses its loaderId as the requestId, and
+    the frame tree holds the loaderId of the document that finally loaded
+    (i.e. after any Cloudflare interstitial). Must be called with browser_lock held.
+    """
+    loader_id = driver.execute_cdp_cmd('Page.getFrameTree', {})['frameTree']['frame']['loaderId']
+    response = driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': loader_id})
+    if response['base64Encoded']:
+        return base64.b64decode(response['body'])
+    return response['body'].encode('utf-8')
+
+def close_tab(driver, target_id):
+    """
+    Closes a tab of the shared browser and switches back to its main window.
+    """
+    with browser_lock:
+        try:
+            driver.execute_cdp_cmd('Target.closeTarget', {'targetId': target_id})
+            driver.switch_to.window(browser_main_handle)
+        except Exception:
+            pass
 
-def fetch_and_parse_sitemap(url, headless_mode=True):
+def fetch_page_with_uc(url):
     """
-    Worker function: Launches a browser, fetches a sitemap URL, waits for it to load,
-    parses the content, and returns a list of URLs.
+    Last-resort fetcher: opens the URL in a new tab of the shared browser,
+    waits for the sitemap to load and returns the raw response body (or None on failure).
     """
-    options = uc.ChromeOptions()
-    if headless_mode:
-        options.add_argument('--headless')
-        
-    driver = None
+    target_id = None
+    try:
+        with browser_lock:
+            driver = get_shared_browser()
+            # ChromeDriver window handles are CDP target ids. The tab starts blank
+            # so resource blocking is in place before the sitemap starts loading.
+            target_id = driver.execute_cdp_cmd('Target.createTarget', {'url': 'about:blank'})['targetId']
+            driver.switch_to.window(target_id)
+            driver.execute_cdp_cmd('Network.enable', NETWORK_BUFFER_LIMITS)
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_RESOURCE_PATTERNS})
+            # Unlike driver.get, Page.navigate returns without waiting for the load
+            driver.execute_cdp_cmd('Page.navigate', {'url': url})
+    except Exception as e:
+        log.warning(f"[BROWSER ERROR] Could not open a tab for {url}: {e}")
+        if target_id is not None:
+            close_tab(driver, target_id)
+        return None
+
+    def document_ready(driver):
+        with browser_lock:
+            driver.switch_to.window(target_id)
+            return driver.execute_script(DOCUMENT_READY_JS)
+
     try:
-        driver = uc.Chrome(options=options)
-        driver.get(url)
-        
-        # --- MODIFIED: Increased timeout to 4 minutes (240 seconds) ---
-        wait = WebDriverWait(driver, 240)
-        wait.until(EC.presence_of_element_located((By.TAG_NAME, "loc")))
-        
-        page_content = driver.page_source
-
-        # Parse the content directly in the worker
-        if not page_content:
-            return []
-        soup = BeautifulSoup(page_content, 'lxml')
-        loc_tags = soup.find_all('loc')
-        return [tag.text for tag in loc_tags]
+        # A loaded XML document is final, so there is no need to poll for <loc> elements
+        # A poll can fail with "document unloaded" while the interstitial navigates away.
+        # Anything else (e.g. a crashed browser or a closed window) ends the wait at once.
+        wait = WebDriverWait(driver, BROWSER_TIMEOUT, poll_frequency=BROWSER_POLL_INTERVAL,
+                             ignored_exceptions=(JavascriptException,))
+        wait.until(document_ready)
+
+        with browser_lock:
+            driver.switch_to.window(target_id)
+            page_content = get_document_body(driver)
+
+        if b'<loc' not in page_content:
+            log.warning(f"[BROWSER ERROR] Page loaded without any <loc> entries: {url}")
+            return None
+        return page_content
 
     except TimeoutException:
-        # --- ADDED: Better error logging ---
-        # This will now show up in the GitHub Actions log if a specific URL fails.
-        print(f"\n[WORKER TIMEOUT] Timed out waiting for content on: {url}")
-        return []
+        # This ends up in WORKER_LOG_FILE (uploaded as an artifact) if a specific URL fails.
+        log.warning(f"[BROWSER TIMEOUT] Timed out waiting for the page to load: {url}")
+        return None
     except Exception as e:
-        print(f"\n[WORKER ERROR] An unexpected error occurred for {url}: {e}")
-        return []
+        log.warning(f"[BROWSER ERROR] An unexpected error occurred for {url}: {e}")
+        return None
     finally:
-        if driver:
-            driver.quit()
+        close_tab(driver, target_id)
 
-# --- Main execution block ---
-if __name__ == "__main__":
-    start_time = time.time()
-    
-    # --- Step 1: Fetch the main sitemap index (with a VISIBLE browser) ---
-    print("--- Step 1: Fetching main sitemap index (visible browser in virtual display) ---")
-    # Using a list comprehension to get the result from the single call
-    sub_sitemaps = fetch_and_parse_sitemap(SITEMAP_INDEX_URL, headless_mode=False)
-    
-    if not sub_sitemaps:
-        print("\nCRITICAL ERROR: Script failed to retrieve or parse the main sitemap index.")
-        exit()
-        
-    print(f"-> Success! Found {len(sub_sitemaps)} sub-sitemap URLs.")
-    
-    all_product_urls = set()
-
-    # --- Step 2: Concurrently process all sub-sitemaps (in HEADLESS mode) ---
-    print(f"\n--- Step 2: Processing {len(sub_sitemaps)} sub-sitemaps with {MAX_WORKERS} workers ---")
-    
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_url = {executor.submit(fetch_and_parse_sitemap, url, headless_mode=True): url for url in sub_sitemaps}
-        
-        for future in tqdm(as_completed(future_to_url), total=len(sub_sitemaps), desc="Processing Sitemaps"):
+def parse_urls_from_sitemap_content(page_content):
+    """
+    Extracts the set of <loc> URLs in a sitemap document by scanning its raw
+    bytes with LOC_RE. XML entities (&amp;, &apos;, numeric references, ...)
+    are decoded only where present.
+    Returning a set dedupes each sitemap before it is merged into the results.
+    """
+    if not page_content:
+        return set()
+
+    urls = set()
+    for raw_url in LOC_RE.findall(page_content):
+        url = raw_url.decode('utf-8')
+        urls.add(unescape(url) if '&' in url else url)
+    return urls
+
+def is_challenge(response, content, expect_loc=False):
+    """
+    Tells whether a response is Cloudflare (or a similar gate) refusing plain HTTP.
+    With expect_loc, a 200 without any <loc> entries counts as a challenge too.
+    """
+    return (response.status_code in CHALLENGE_STATUS_CODES
+            or response.headers.get('cf-mitigated') == 'challenge'
+            or (expect_loc and response.status_code == 200 and b'<loc' not in content))
+
+async def fetch_over_http(client, url, header_ladder=(None,), conditional_headers=None, expect_loc=False):
+    """
+    Fetches a sitemap over plain HTTP, trying each header set of the ladder in
+    turn while the response is a challenge. Returns a (response, content,
+    challenged) tuple; content is None unless a real sitemap came back (a 304
+    Not Modified answer to conditional_headers also has no content).
+
+    expect_loc makes a 200 without <loc> entries count as a challenge. Only the
+    index sets it; an empty sub-sitemap is not worth escalating to a browser.
+    """
+    for headers in header_ladder:
+        if conditional_headers:
+            headers = {**(headers or {}), **conditional_headers}
+        response = await client.get(url, headers=headers)
+        content = decode_sitemap_body(url, response.content)
+        if content is None:
+            return response, None, False
+        if not is_challenge(response, content, expect_loc):
+            if response.status_code == 304:
+                return response, None, False
+            if response.status_code != 200:
+                log.warning(f"[WORKER ERROR] HTTP {response.status_code} for {url}")
+                return response, None, False
+            return response, content, False
+    return response, None, True
+
+def get_conditional_headers(meta):
+    """
+    Builds If-Modified-Since / If-None-Match headers from a cache entry's metadata.
+    """
+    headers = {}
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    return headers
+
+async def fetch_and_parse_sitemap(client, url, semaphore, header_ladder=(None,), allow_browser_fallback=True,
+                                  cache=None, expect_loc=False):
+    """
+    Worker coroutine: fetches a sitemap URL over plain HTTP and returns the set
+    of URLs it contains. Challenged responses are retried through cloudscraper,
+    and then (unless disabled) through a tab of the shared browser. Both
+    fallbacks are blocking, so they run in a worker thread.
+
+    With a cache, the parsed URLs are stored per sitemap URL. Fresh entries are
+    returned as-is (as the already-deduped cached list) and stale ones are
+    revalidated with a conditional request; if that fails, the stale list is
+    still returned. The cache is read under the semaphore too, so a warm cache
+    can't load every sitemap at once. Metadata (fetch time and validators)
+    lives under its own ('meta', url) key, so a 304 doesn't rewrite the URL list.
+    """
+    meta_key = ('meta', url)
+
+    def cached_urls(reason):
+        urls = cache.get(url) if meta else None
+        if urls is None:
+            return set()
+        log.warning(f"[CACHE] {reason}; using the cached URLs for {url}")
+        return urls
+
+    async with semaphore:
+        meta = cache.get(meta_key) if cache is not None else None
+        if meta and time.time() - meta['fetched_at'] < SITEMAP_CACHE_TTL:
+            urls = cache.get(url)
+            if urls is not None:
+                return urls
+            meta = None
+
+        try:
+            response, page_content, challenged = await fetch_over_http(
+                client, url, header_ladder, get_conditional_headers(meta) if meta else None, expect_loc)
+        except httpx.HTTPError as e:
+            log.warning(f"[WORKER ERROR] Request failed for {url}: {e}")
+            return cached_urls("Revalidation failed")
+
+        if meta and response.status_code == 304:
+            cache.set(meta_key, {**meta, 'fetched_at': time.time()})
+            return cache.get(url) or set()
+
+        if challenged:
             try:
-                urls_from_sitemap = future.result()
-                if urls_from_sitemap:
-                    all_product_urls.update(urls_from_sitemap)
+                page_content = await asyncio.to_thread(fetch_page_with_cloudscraper, url)
             except Exception as e:
-                print(f"A task generated an exception: {e}")
+                log.warning(f"[WORKER ERROR] cloudscraper failed for {url}: {e}")
+                page_content = None
+            # Chromium downloads .xml.gz files instead of rendering them, so a tab can't help there
+            if page_content is None and allow_browser_fallback and not is_gzip_url(url):
+                page_content = await asyncio.to_thread(fetch_page_with_uc, url)
+
+    if page_content is None:
+        return cached_urls("Revalidation failed")
+
+    urls = parse_urls_from_sitemap_content(page_content)
+    if cache is not None and urls:
+        # Validators only make sense when the body came from this response
+        validators = response.headers if not challenged else {}
+        # The URL list goes in first, so metadata never points at a missing list
+        cache.set(url, list(urls))
+        cache.set(meta_key, {
+            'fetched_at': time.time(),
+            'last_modified': validators.get('Last-Modified'),
+            'etag': validators.get('ETag'),
+        })
+    return urls
+
+def start_dedup_sort():
+    """
+    Starts `sort -u` writing to OUTPUT_FILE. URLs are streamed into its stdin
+    as sitemaps complete, so the full result set never sits in Python memory.
+    LC_ALL=C gives a plain byte-order sort (the same order as sorted() on str).
+    """
+    env = dict(os.environ, LC_ALL='C')
+    return subprocess.Popen(['sort', '-u', '-S', SORT_BUFFER_SIZE, '-o', OUTPUT_FILE],
+                            stdin=subprocess.PIPE, text=True, encoding='utf-8', env=env)
+
+def count_lines(path):
+    """
+    Counts the lines of a file without loading it whole.
+    """
+    with open(path, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+
+async def main():
+    start_time = time.perf_counter()
+    log_handler = logging.FileHandler(WORKER_LOG_FILE, mode='w', encoding='utf-8')
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    log.addHandler(log_handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    # The browser is quit however Steps 1-2 end, so Chromium never outlives the script
+    try:
+        async with create_http_client() as client:
+            # --- Step 1: Fetch the main sitemap index (falls back to a VISIBLE browser if challenged) ---
+            print("--- Step 1: Fetching main sitemap index ---")
+            sub_sitemaps = await fetch_and_parse_sitemap(client, SITEMAP_INDEX_URL, semaphore,
+                                                         header_ladder=INDEX_HEADER_LADDER, expect_loc=True)
+
+            if not sub_sitemaps:
+                print("\nCRITICAL ERROR: Script failed to retrieve or parse the main sitemap index.")
+                sys.exit(1)
+
+            print(f"-> Success! Found {len(sub_sitemaps)} sub-sitemap URLs.")
+
+            # If the index needed the browser, let the sub-sitemap requests ride on its clearance
+            apply_browser_session(client)
+
+            # --- Step 2: Concurrently process all sub-sitemaps over HTTP ---
+            print(f"\n--- Step 2: Processing {len(sub_sitemaps)} sub-sitemaps with up to {MAX_CONCURRENT_REQUESTS} concurrent requests ---")
+
+            # Results are streamed straight into the dedup sort instead of being held in a set
+            sort_process = start_dedup_sort()
+            sort_error = None
+            with diskcache.Cache(SITEMAP_CACHE_DIR) as cache:
+                tasks = [asyncio.create_task(fetch_and_parse_sitemap(client, url, semaphore, cache=cache))
+                         for url in sub_sitemaps]
+                for future in tqdm(asyncio.as_completed(tasks), total=len(sub_sitemaps), desc="Processing Sitemaps"):
+                    try:
+                        urls_from_sitemap = await future
+                    except Exception as e:
+                        log.warning(f"A task generated an exception: {e}")
+                        continue
+                    if not urls_from_sitemap:
+                        continue
+                    # sort stops reading while it spills a full buffer, so the
+                    # (possibly blocking) pipe write must stay off the event loop
+                    try:
+                        await asyncio.to_thread(sort_process.stdin.write, '\n'.join(urls_from_sitemap) + '\n')
+                    except OSError as e:
+                        # sort died; nothing more can be saved, so stop fetching
+                        sort_error = e
+                        for task in tasks:
+                            task.cancel()
+                        await asyncio.gather(*tasks, return_exceptions=True)
+                        break
+    finally:
+        close_shared_browser()
 
     # --- Step 3: Save the final results ---
-    print(f"\nAll sitemaps processed. Found {len(all_product_urls):,} unique product URLs.")
-    print(f"Saving results to '{OUTPUT_FILE}'...")
-    
-    sorted_urls = sorted(list(all_product_urls))
-    
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        for url in sorted_urls:
-            f.write(url + '\n')
-            
-    end_time = time.time()
+    print(f"\nAll sitemaps processed. Deduplicating and saving results to '{OUTPUT_FILE}'...")
+
+    try:
+        sort_process.stdin.close()
+    except OSError as e:
+        sort_error = sort_error or e
+    if sort_process.wait() != 0 or sort_error:
+        reason = f" ({sort_error})" if sort_error else ""
+        print(f"\nCRITICAL ERROR: sort exited with status {sort_process.returncode} while writing '{OUTPUT_FILE}'{reason}.")
+        # Fail the workflow step rather than upload a missing or partial result file
+        sys.exit(1)
+    total_urls = count_lines(OUTPUT_FILE)
+
+    end_time = time.perf_counter()
 
     print("\n" + "="*40)
     print("        Extraction Complete!")
     print("="*40)
-    print(f"Total unique product URLs found: {len(sorted_urls):,}")
+    print(f"Total unique product URLs found: {total_urls:,}")
     print(f"Results saved to '{OUTPUT_FILE}'.")
     print(f"Total time taken: {end_time - start_time:.2f} seconds.")
+    print(f"Per-URL warnings (if any) logged to '{WORKER_LOG_FILE}'.")
     print("="*40)
+
+
+# --- Main execution block ---
+if __name__ == "__main__":
+    asyncio.run(main())